@@ -34,36 +34,42 @@
 
 import sys
 import os
+import re
 import argparse
+from bisect import bisect_right
+from operator import itemgetter
 
 class SrcFile():
-	def __init__(self):
-		self.code = 0	# code in ROM
-		self.rodata = 0 # data in ROM (read only)
-		self.data = 0	# initialized data in RAM
-		self.bss = 0	# uninitialized data in RAM
-		self.etc = 0
+	__slots__ = ('name', 'c')
+
+	CODE, RODATA, DATA, BSS, ETC = range(5) # index of counter in self.c
+
+	field = (('.text', CODE), ('.rodata', RODATA), ('.data', DATA), ('.bss', BSS)) # section prefix : counter
+	ignore = ('.comment', '.debug', '.ARM.attributes')
+
+	def __init__(self, name):
+		self.name = name
+		# code in ROM, data in ROM (read only), initialized data in RAM, uninitialized data in RAM, etc
+		self.c = [0, 0, 0, 0, 0]
 
 	def total(self):
-		return self.code + self.rodata + self.data + self.bss + self.etc
-
-	def add(self, section, size):
-		if section.startswith('.text'):
-			self.code += size
-		elif section.startswith('.rodata'):
-			self.rodata += size
-		elif section.startswith('.data'):
-			self.data += size
-		elif section.startswith('.bss'):
-			self.bss += size
-		elif section.startswith(('.comment', '.debug', '.ARM.attributes')):
-			return # ignore
-		else:
-			self.etc += size
+		return sum(self.c)
+
+	@staticmethod
+	def classify(section): # counter index of section ('.textcritical' -> CODE), None for ignored section
+		for prefix, field in SrcFile.field:
+			if section.startswith(prefix):
+				return field
+		if section.startswith(SrcFile.ignore):
+			return None
+		return SrcFile.ETC
 
 
 class Section():
-	def __init__(self):
+	__slots__ = ('name', 'size', 'start')
+
+	def __init__(self, name):
+		self.name = name
 		self.size = 0
 		self.start = 0
 	def add(self, start, size):
@@ -74,37 +80,68 @@ class Section():
 
 
 class Memory():
+	__slots__ = ('name', 'start', 'end', 'total', 'use', 'section', 'section_idx')
+
 	def __init__(self, name, start, length):
 		self.name = name
 		self.start = start
 		self.end = start + length - 1
 		self.total = length
 		self.use = 0
-		self.section = {} # Section
+		self.section = [] # Section, in map file order
+		self.section_idx = {} # section name : index in self.section
+
+	def find(self, section_name):
+		i = self.section_idx.get(section_name)
+		return None if i is None else self.section[i]
 
 	def add(self, section_name, start, size):
-		if section_name not in self.section:
-			self.section[section_name] = Section()
-		self.section[section_name].add(start, size)
+		i = self.section_idx.get(section_name)
+		if i is None:
+			i = self.section_idx[section_name] = len(self.section)
+			self.section.append(Section(section_name))
+		self.section[i].add(start, size)
 		self.use += size
 
 # ---------- Global ----------
 
 mem_list = []
+mem_by_name = {}	# name : Memory
+mem_by_start = []	# Memory sorted by start address
+mem_start = []		# start address of mem_by_start, for bisect
+mem_disjoint = True	# no two regions overlap, bisect finds the only candidate
 file_list = {}
 
+hex_pat = re.compile(r'0x[0-9a-fA-F]+$')
+max_fill = 1 << 24	# '*fill*' bigger than whole RP2040 flash is a linker miscalculation
+
 # ---------- functions ----------
 
+def index_mem():
+	global mem_disjoint
+	mem_by_name.clear()
+	mem_by_name.update((mem.name, mem) for mem in mem_list)
+	mem_by_start[:] = sorted(mem_list, key = lambda mem: mem.start)
+	mem_start[:] = [mem.start for mem in mem_by_start]
+	mem_disjoint = all(prev.end < mem.start for prev, mem in zip(mem_by_start, mem_by_start[1:]))
+
 def find_mem(name):
-	for mem in mem_list:
-		if mem.name == name:
-			return mem
+	return mem_by_name.get(name)
 
 def add_section_to_mem(section, start, size):
-	for mem in mem_list:
-		if (start >= mem.start) and ((start + size-1) <= mem.end):
-			mem.add(section, start, size)
-			return
+	if not mem_disjoint: # overlapping regions (e.g. RAM and SCRATCH_X), first region in map order wins
+		for mem in mem_list:
+			if (start >= mem.start) and ((start + size-1) <= mem.end):
+				mem.add(section, start, size)
+				return
+		return
+
+	i = bisect_right(mem_start, start) - 1
+	if i < 0:
+		return
+	mem = mem_by_start[i]
+	if (start + size-1) <= mem.end:
+		mem.add(section, start, size)
 
 def kb(size):
 	if size % 1024 == 0:
@@ -126,7 +163,7 @@ def main():
 	args = parser.parse_args()
 
 	with open(args.map_file) as f:
-		lines = iter(f)
+		lines = iter(f) # lines keep their '\n', strip only what is kept
 
 		### advance to "Memory Configuration"
 		for line in lines:
@@ -134,42 +171,25 @@ def main():
 				break
 
 		for line in lines:
-			line = line.strip('\n')
-
 			if line.strip() == "Linker script and memory map":
 				break
 
 			### parse "Memory Configuration"
 			part = line.split(None, 4)
-			if len(part) < 3:
-				continue
-
-			try:
-				mem = Memory(part[0], int (part[1], 16), int (part[2], 16))
-			except:
+			if len(part) < 3 or not (hex_pat.match(part[1]) and hex_pat.match(part[2])):
 				continue
 
 			if not part[0].startswith('*'):	# exclude '*default*'
-				mem_list.append(mem)
+				mem_list.append(Memory(part[0], int (part[1], 16), int (part[2], 16)))
+
+		index_mem()
 
 		### parse "Linker script and memory map"
 
-		cur_sec = None
+		cur_field = None	# counter of current section, see SrcFile.classify()
 		split_line = None
 
 		for line in lines:
-			line = line.strip('\n')
-
-			### check section size
-			if line.startswith("."):
-				part = line.split(None, 3)
-
-				if len(part) >= 3:
-					start = int(part[1], 16)
-					size = int(part[2], 16)
-					if (size > 0):
-						add_section_to_mem(part[0], start, size)
-
 			if split_line: # Glue a line that was split in two back together
 				if line.startswith(' ' * 16):
 					line = split_line + line
@@ -177,97 +197,105 @@ def main():
 					print("Warning: discarding line ", split_line)
 				split_line = None
 
-			if line.startswith((".", " .", " *fill*")):
-				part = line.split(None, 3)
-
-				if (line.startswith('.')): # start of section
-					cur_sec = part[0]
-
-				elif len(part) == 1 and len(line) > 14:
-					split_line = line
-
-				elif len(part) >= 3 and "=" not in part and 'before' not in part:
-					if part[0] == '*fill*': # CAUTION : sometimes linker generate incorrect value for 'fill' section
-						source = part[0]
-						size = int(part[-1], 16)
-
-					else:
-						source = part[-1]
-						size = int(part[-2], 16)
-						start = int(part[-3], 16)
+			if not line.startswith((".", " .", " *fill*")): # symbol, assignment, LOAD, ...
+				if line.startswith("Cross Reference Table"): # '--cref' output, no more sections
+					break
+				continue
 
-					# combine several '*.a' files in one file
-					# if '.a(' in source:
-					# 	source = source[:source.index('.a(') + 2]
-					# elif source.endswith('.o'):
-					# 	where = max(source.rfind('\\'), source.rfind('/'))
-					# 	if where:
-					# 		source = source[:where + 1] + '*.o'
+			part = line.split(None, 3)
 
-					if source not in file_list:
-						file_list[source] = SrcFile()
+			if line[0] == '.': # start of section
+				cur_field = SrcFile.classify(part[0])
 
-					file_list[source].add(cur_sec, size)
+				### check section size
+				if len(part) >= 3:
+					size = int(part[2], 16)
+					if (size > 0):
+						add_section_to_mem(part[0], int(part[1], 16), size)
+
+			elif len(part) == 1 and len(part[0]) > 13: # long name, start/size/source on the next line
+				split_line = line.rstrip('\n')
+
+			elif len(part) >= 3 and part[2][:2] == '0x': # not '. = ALIGN (0x4)'
+				# ignored sections and empty input sections are common, skip int() for them
+				if cur_field is None or part[2] == '0x0':
+					size = 0
+				else:
+					size = int(part[2], 16) # '*fill*' may have a fill pattern after the size
+
+				if part[0] == '*fill*': # CAUTION : sometimes linker generate incorrect value for 'fill' section
+					if size >= max_fill:
+						continue
+					source = part[0]
+				else:
+					source = part[-1].rstrip('\n')
+
+				# combine several '*.a' files in one file
+				# if '.a(' in source:
+				# 	source = source[:source.index('.a(') + 2]
+				# elif source.endswith('.o'):
+				# 	where = max(source.rfind('\\'), source.rfind('/'))
+				# 	if where:
+				# 		source = source[:where + 1] + '*.o'
+
+				ent = file_list.get(source)
+				if ent is None:
+					ent = file_list[source] = SrcFile(source)
+
+				if size:
+					ent.c[cur_field] += size
 
 		### Append '.data' section to FLASH area, elf.map don't provide this info.
 
-		try:
-			ram_data = find_mem('RAM').section['.data']
-			rom = find_mem('FLASH')
+		ram = find_mem('RAM')
+		rom = find_mem('FLASH')
+		ram_data = ram.find('.data') if ram else None
+		if ram_data and rom:
 			add_section_to_mem('.data(image)', rom.start + rom.use, ram_data.size)
-		except:
-			pass
 
 		### Sorting option
 
-		sources = list(file_list.keys())
+		rows = [(ent.total(), *ent.c, ent.name) for ent in file_list.values()] # total, code, rodata, data, bss, etc, name
 		if args.code:
-			sources.sort(key = lambda x: file_list[x].code)
+			rows.sort(key = itemgetter(1))
 		elif args.bss:
-			sources.sort(key = lambda x: file_list[x].bss)
+			rows.sort(key = itemgetter(4))
 		elif args.rodata:
-			sources.sort(key = lambda x: file_list[x].rodata)
+			rows.sort(key = itemgetter(2))
 		elif args.data:
-			sources.sort(key = lambda x: file_list[x].data)
+			rows.sort(key = itemgetter(3))
 
 		### Print out
 
-		print('********** File **********')
-		sumtotal = sumcode = sumdata = sumbss = sumrodata = sumetc = 0
-		print(' Total   code rodata   data    bss    etc FILE')
-		for source in sources:
-			ent = file_list[source]
-			sumcode += ent.code
-			sumdata += ent.data
-			sumbss += ent.bss
-			sumrodata+= ent.rodata
-			sumetc+= ent.etc
-			sumtotal += ent.total()
-
-			print('%6d %6d %6d %6d %6d %6d %s'%(ent.total(), ent.code, ent.rodata,
-				ent.data, ent.bss, ent.etc, source))
-
-		print('%6d %6d %6d %6d %6d %6d SUMMARY'%(sumtotal, sumcode, sumrodata, sumdata, sumbss, sumetc))
-		print(' Total   code rodata   data    bss    etc FILE')
-		print("*) In some cases, the values may not match exactly (I've seen the linker miscalculate the '*fill*' size)")
-
-		print(' ')
-		print('********** Memory **********')
+		out = []	# whole report, written at once
+
+		out.append('********** File **********')
+		out.append(' Total   code rodata   data    bss    etc FILE')
+		row_fmt = '%6d %6d %6d %6d %6d %6d %s'
+		out.extend([row_fmt%row for row in rows])
+
+		sums = tuple(sum(row[i] for row in rows) for i in range(6)) # total, code, rodata, data, bss, etc
+		out.append('%6d %6d %6d %6d %6d %6d SUMMARY'%sums)
+		out.append(' Total   code rodata   data    bss    etc FILE')
+		out.append("*) '*fill*' entries of 16MB or more are a linker miscalculation and are not counted")
+
+		out.append(' ')
+		out.append('********** Memory **********')
 		for mem in mem_list:
-			print("%10s  %08xh ~ %08xh  Total %8s  Used %6dB  Ratio %5.1f%%"%
+			out.append("%10s  %08xh ~ %08xh  Total %8s  Used %6dB  Ratio %5.1f%%"%
 				(mem.name, mem.start, mem.end, kb(mem.total), mem.use, (mem.use * 100) / (mem.end - mem.start)))
 
-		print(' ')
-		print('********** Sector **********')
+		out.append(' ')
+		out.append('********** Sector **********')
 		for mem in mem_list:
-			for sect_name in mem.section:
-				sect = mem.section[sect_name]
-				print("%10s : %15s %08xh ~ %08xh Size %8s (%6dB)  %6.2f%%"%
+			for sect in mem.section:
+				out.append("%10s : %15s %08xh ~ %08xh Size %8s (%6dB)  %6.2f%%"%
 					(mem.name,
-					sect_name, sect.start, sect.start + sect.size - 1, kb(sect.size), sect.size,
+					sect.name, sect.start, sect.start + sect.size - 1, kb(sect.size), sect.size,
 					(sect.size * 100) / mem.use	))
 
-		print(" ")
+		out.append(" ")
+		sys.stdout.write('\n'.join(out) + '\n')
 
 if __name__ == '__main__':
 	main()